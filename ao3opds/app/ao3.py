@@ -89,7 +89,8 @@ def set_credentials(username, password):
     # Attempt to authenticate with AO3:
     # raises `AO3.utils.LoginError`
     session = AO3.Session(username, password)
-
+    # Serialize the session once, for whichever record we write below:
+    session_blob = dump_ao3_session(session)
 
     # If switching to another AO3 user account, drop the existing
     # records (which will cause following code to create new ones):
@@ -102,7 +103,7 @@ def set_credentials(username, password):
         db.execute(
             "INSERT INTO ao3 (user_id, username, password, session)"
             " VALUES (?, ?, ?, ?)",
-            (user_id, username, password, dump_ao3_session(session)))
+            (user_id, username, password, session_blob))
         db.commit()  # Save changes to db file
         # Prepopulate `feed` table with no-content feeds so that the
         # user can manage their sharing permissions:
@@ -113,7 +114,7 @@ def set_credentials(username, password):
     db.execute(
         "UPDATE ao3 SET username = ?, password = ?, session = ?,"
         " updated = CURRENT_TIMESTAMP WHERE user_id = ?",
-        (username, password, dump_ao3_session(session), user_id))
+        (username, password, session_blob, user_id))
     db.commit() # Save changes to file
     # Update `g` attributes with new AO3 record and session:
     load_ao3_credentials()
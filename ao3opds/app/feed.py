@@ -1,4 +1,5 @@
 import datetime
+from typing import Iterable
 from flask import (
     Blueprint, g, request, render_template, Response, flash)
 from werkzeug.exceptions import abort
@@ -31,8 +32,11 @@ FEED_MIME_TYPE = 'text/xml'
 
 blueprint = Blueprint('feed', __name__, url_prefix='/feed')
 
-def feed_view(feed:str) -> Response:
-    """ Call this when returning from a view that displays a feed. """
+def feed_view(feed:str | Iterable[str]) -> Response:
+    """ Call this when returning from a view that displays a feed.
+
+    `feed` may be a str or an iterable of str chunks, which are streamed.
+    """
     response = Response(feed, mimetype=FEED_MIME_TYPE)
     return response
 
@@ -79,19 +83,15 @@ def prepopulate_feeds(user_id):
         return
     # Create each dummy feed with a stale `updated` attribute:
     updated = datetime.datetime.now() - 2 * REFRESH_FREQUENCY
-    for feed_type in FEED_TYPES:
-        record = db.execute(
-            'SELECT * FROM feed'
-            ' WHERE (feed_type = ? AND user_id = ? AND ao3_id = ?)',
-            (feed_type, user_id, ao3_id)).fetchone()
-        # If we found a record, move on to the next feed type:
-        if record is not None:
-            continue
-        # Add a dummy entry for this user (NULL content):
-        db.execute(
-            'INSERT INTO feed (user_id, ao3_id, feed_type, updated, content)'
-            ' VALUES (?, ?, ?, ?, ?)',
-            (user_id, ao3_id, feed_type, updated, None))
+    # Add a dummy entry (NULL content) for each feed type. Feeds are
+    # unique per (user_id, feed_type), so let the database skip any
+    # that already exist rather than looking each one up first:
+    db.executemany(
+        'INSERT INTO feed (user_id, ao3_id, feed_type, updated, content)'
+        ' VALUES (?, ?, ?, ?, ?)'
+        ' ON CONFLICT (user_id, feed_type) DO NOTHING',
+        [(user_id, ao3_id, feed_type, updated, None)
+         for feed_type in FEED_TYPES])
     db.commit()  # Save changes to database
 
 def render_feed(feed_type):
@@ -108,13 +108,15 @@ def render_feed(feed_type):
             request.args.get('u') and request.args.get('p') # Credentials provided
         ):
         # Spin up an anonymous session:
-        ao3_username = request.args.get['u']
-        ao3_password = request.args.get['p']
+        ao3_username = request.args.get('u')
+        ao3_password = request.args.get('p')
         try:
             session = AO3.Session(ao3_username, ao3_password)
         except AO3.utils.LoginError as err:
             abort(401, "Could not authenticate with AO3: " + str(err))
-        return feed_view(fetch_feed(session, threaded=True))
+        # Anonymous feeds aren't cached, so there's no need to hold the
+        # whole feed in memory; stream it to the client instead:
+        return feed_view(fetch_feed(session, threaded=True, stream=True))
     # Check to see whether there is an active AO3 session:
     elif g.ao3_session is None:  # no logged in user, no credentials:
         abort(401, "Must authenticate with AO3 to view feeds.")
@@ -198,12 +200,13 @@ def manage():
         g.feeds = db.execute(
             'SELECT * FROM feed WHERE user_id = ?', (user_id,)).fetchall()
         # For each feed, set the `share_enabled` property based on
-        # whether the checkbox in the form was checked:
-        for feed in g.feeds:
-            share_enabled = 1 if request.form.get(feed['share_key']) else 0
-            db.execute(
-                'UPDATE feed SET share_enabled = ? WHERE share_key = ?',
-                (share_enabled, feed['share_key']))
+        # whether the checkbox in the form was checked. Build all of
+        # the parameters up front so that the updates run as a batch:
+        updates = [
+            (1 if request.form.get(feed['share_key']) else 0, feed['share_key'])
+            for feed in g.feeds]
+        db.executemany(
+            'UPDATE feed SET share_enabled = ? WHERE share_key = ?', updates)
         db.commit()
     # Get the list of feeds (as updated, if applicable) and render:
     g.feeds = db.execute(
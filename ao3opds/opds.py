@@ -3,17 +3,36 @@
 from dataclasses import dataclass
 import concurrent.futures
 import datetime
+import functools
+import itertools
 import mimetypes
+import os
+import sys
+import time
 import urllib.parse
-from typing import Iterable
+from typing import Iterable, Iterator
 import warnings
-from jinja2 import Environment, PackageLoader, select_autoescape
+from jinja2 import (
+    Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape)
+import soupsieve
 import AO3
 
+# Optionally cache compiled templates on disk (in this directory) so
+# that new processes (e.g. web app workers) can skip compiling them:
+JINJA_CACHE_DIR = os.environ.get('AO3OPDS_JINJA_CACHE')
+
 env = Environment(
     loader=PackageLoader("ao3opds"),
     autoescape=select_autoescape(),
-    trim_blocks=True)
+    trim_blocks=True,
+    # Templates ship with the package and don't change at runtime, so
+    # don't check them for changes on every render:
+    auto_reload=False,
+    bytecode_cache=(
+        FileSystemBytecodeCache(JINJA_CACHE_DIR) if JINJA_CACHE_DIR
+        else None))
+FEED_TEMPLATE = env.get_template("feed.xml")
+ENTRY_TEMPLATE = env.get_template("entry.xml")
 
 AO3_PUBLISHER = "Archive of Our Own"
 AO3_TAG_SCHEMA = 'https://archiveofourown.org/faq/tags'
@@ -22,6 +41,11 @@ AO3_IMAGE_LINK_REL_THUMB = 'http://opds-spec.org/image/thumbnail'
 AO3_ACQUISITION_LINK_REL = 'http://opds-spec.org/acquisition'
 AO3_DOWNLOAD_FILETYPES = ('AZW3', 'EPUB', 'HTML', 'MOBI', 'PDF')
 AO3_URL_BASE = 'https://archiveofourown.org/'
+# Attributes of `AO3.Work` that hold lists of tags. (The work's rating
+# is also a tag, but it is a single item rather than a list.)
+AO3_TAG_ATTRIBUTES = (
+    'categories', 'fandoms', 'characters', 'relationships', 'warnings',
+    'tags')
 
 # AO3 provides support for 'AZW3', 'EPUB', 'HTML', 'MOBI', and 'PDF'
 AO3_DOWNLOAD_MIME_TYPES = {
@@ -33,10 +57,86 @@ AO3_DOWNLOAD_MIME_TYPES = {
 # Ensure mimetypes supports each of these:
 for ext, type_ in AO3_DOWNLOAD_MIME_TYPES.items():
     mimetypes.add_type(type_, ext)
+# Map each of these back to a friendly filetype name (e.g. 'PDF'):
+AO3_DOWNLOAD_MIME_FILETYPES = {
+    type_: ext[1:].upper() for ext, type_ in AO3_DOWNLOAD_MIME_TYPES.items()}
+# Images embedded in works are almost always one of these:
+AO3_IMAGE_MIME_TYPES = {
+    '.gif': 'image/gif',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+    '.svg': 'image/svg+xml',
+    '.webp': 'image/webp'}
 
 MAX_THREADS = 4
-
-@dataclass
+# Works are retried (with exponential back-off) if AO3 rate-limits us.
+# This is the only place rate-limited requests are retried; don't also
+# retry HTTP 429 at the connection level, or the retries multiply:
+MAX_LOAD_ATTEMPTS = 3
+LOAD_BACKOFF = 2  # seconds; doubled after each rate-limited attempt
+# Number of rendered pieces joined into each chunk of a streamed feed:
+STREAM_BUFFER_SIZE = 16
+# Matches the link for each option in a work's "Download" menu:
+DOWNLOAD_LINK_SELECTOR = soupsieve.compile('li.download li > a')
+# Name of the attribute used to cache a work's download links:
+_DOWNLOAD_LINKS_CACHE = '_ao3opds_download_links'
+
+def _normalize_filetypes(
+        filetypes: str | Iterable[str] | None) -> frozenset[str] | None:
+    """ Converts filetypes to a lowercase set for easy comparison. """
+    if filetypes is None:
+        return None
+    # For convenience, allow users to pass a single filetype as str:
+    if isinstance(filetypes, str):
+        filetypes = [filetypes]
+    return frozenset(map(str.lower, filetypes))
+
+def _guess_mime_type(url: str, mime_types: dict[str, str]) -> str | None:
+    """ Infers the MIME-type of the file at `url` (None if not inferable)
+
+    `mime_types` maps expected extensions (e.g. '.pdf') to MIME-types.
+    These are checked first, falling back to `mimetypes` for others.
+    """
+    # Strip any non-path elements (i.e. query/fragment suffixes).
+    # Slicing the string is enough; no need to parse the URL.
+    # (`mimetypes` also seems to have better luck with stripped URLs.)
+    path = url.partition('?')[0].partition('#')[0]
+    mime = mime_types.get(os.path.splitext(path)[1].lower())
+    if mime is None:
+        (mime, _) = mimetypes.guess_type(path)
+    return mime
+
+def _load_work(work: AO3.Work, load_chapters: bool=False):
+    """ Loads `work`, backing off and retrying if AO3 rate-limits us. """
+    delay = LOAD_BACKOFF
+    for attempt in range(MAX_LOAD_ATTEMPTS):
+        try:
+            work.reload(load_chapters=load_chapters)
+            return
+        # `AO3` raises this when it gets an HTTP 429 response:
+        except AO3.utils.HTTPError:
+            if attempt == MAX_LOAD_ATTEMPTS - 1:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+def _cached_author(
+        user: AO3.User | str,
+        cache: dict[str, 'AO3UserOPDS']) -> 'AO3UserOPDS':
+    """ Gets the `AO3UserOPDS` for `user` from `cache`, adding it if new. """
+    username = user if isinstance(user, str) else user.username
+    author = cache.get(username)
+    if author is None:
+        author = cache[username] = AO3UserOPDS(user)
+    return author
+
+def _isoformat_utc(dt: datetime.datetime) -> str:
+    """ Formats `dt` as an ISO 8601 string in UTC (as OPDS expects). """
+    # AO3 only records dates to the second, so don't format any finer:
+    return dt.astimezone(datetime.timezone.utc).isoformat(timespec='seconds')
+
+@dataclass(slots=True)
 class OPDSLink:
     """ An object renderable as an atom:link. """
     href: str # required
@@ -46,14 +146,14 @@ class OPDSLink:
     title: str = None
     length: int = None
 
-@dataclass
+@dataclass(slots=True)
 class OPDSPerson:
     """ An object renderable as an atom:Person. """
     name: str # required
     uri: str = None
     email: str = None
 
-@dataclass
+@dataclass(slots=True)
 class OPDSCategory:
     """ An object renderable as an atom:category. """
     term: str
@@ -67,7 +167,9 @@ class AO3OPDS:
             self, works: Iterable[AO3.Work], id: str, title: str,
             links: Iterable[OPDSLink]=None, updated:datetime.datetime=None,
             authors: Iterable[OPDSPerson]=None,
-            threaded=False):
+            threaded=False, session: AO3.Session=None,
+            max_workers: int=MAX_THREADS,
+            acquisition_filetypes: str | Iterable[str]=None):
         self.id: str = id  # required
         self.title: str = title # required
 
@@ -77,30 +179,51 @@ class AO3OPDS:
 
         self.updated: datetime.datetime = updated
         if updated is None:
-            now = datetime.datetime.now(datetime.timezone.utc)
-            self.updated = now.isoformat()
+            self.updated = _isoformat_utc(
+                datetime.datetime.now(datetime.timezone.utc))
 
         self.authors: Iterable[OPDSPerson] | None = authors
         if self.authors is None:
             self.authors = []
 
+        # Every entry offers the same filetypes, so convert them to a
+        # set once (so that e.g. a generator isn't used up by the first
+        # entry). Entries still lowercase them, which is cheap.
+        # Authors often recur across a feed's works, so entries also
+        # share one `AO3UserOPDS` per author (keyed by username):
+        make_entry = functools.partial(
+            AO3WorkOPDS, session=session,
+            acquisition_filetypes=_normalize_filetypes(acquisition_filetypes),
+            author_cache={})
         if not threaded:
             self.entries: Iterable[AO3WorkOPDS] = []
             for work in works:
-                self.entries.append(AO3WorkOPDS(work))
+                self.entries.append(make_entry(work))
         else:  # threading support!
-            self.entries: Iterable[AO3WorkOPDS] = [None] * len(works)
-            def thread_function(index, work):
-                self.entries[index] = AO3WorkOPDS(work)
-            with concurrent.futures.ThreadPoolExecutor(MAX_THREADS) as exec:
-                exec.map(thread_function, range(len(works)), works)
+            # Loading works is network-bound, so build entries in a pool
+            # of threads. `map` yields entries in the same order as
+            # `works` (and re-raises any error raised in a thread):
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as exec:
+                self.entries: Iterable[AO3WorkOPDS] = list(
+                    exec.map(make_entry, works))
 
     def render(self):
         """ Renders this object as an OPDS feed. """
-        # Pick the correct template (in this case, an OPDS feed):
-        template = env.get_template("feed.xml")
-        # Render the template for this feed and return the result:
-        return template.render(self.__dict__)
+        # Render the feed template for this feed and return the result:
+        return FEED_TEMPLATE.render(feed=self)
+
+    def generate(self, buffer_size:int=STREAM_BUFFER_SIZE) -> Iterator[str]:
+        """ Renders this object as an OPDS feed, piece by piece.
+
+        This yields the same output as `render`, but in chunks, so that
+        large feeds can be streamed (e.g. in a `flask.Response`) without
+        building the whole feed in memory first. Template output is
+        buffered into chunks of `buffer_size` pieces to cut per-chunk
+        overhead (e.g. one write per tag when serving a response).
+        """
+        stream = FEED_TEMPLATE.stream(feed=self)
+        stream.enable_buffering(size=buffer_size)
+        return stream
 
 class AO3WorkOPDS:
     """ An object renderable as an entry in an OPDS feed of AO3 works. """
@@ -108,14 +231,22 @@ class AO3WorkOPDS:
     def __init__(self,
             work:AO3.Work,
             acquisition_filetypes: str | Iterable[str]=None,
-            get_content:bool=False, get_images:bool=False):
+            get_content:bool=False, get_images:bool=False,
+            session: AO3.Session=None,
+            author_cache: dict[str, 'AO3UserOPDS']=None):
         self.work = work
         # Ensure the work's metadata is loaded
         if not work.loaded:
+            # The current version of `ao3_api` does not set the session
+            # on works returned from methods such as
+            # `session.get_marked_for_later()`. We only need one to load
+            # the work, so attach it here (if provided):
+            if session is not None:
+                work.set_session(session)
             # Only load the full-text if we need to:
             load_chapters = get_content or get_images
             try:
-                work.reload(load_chapters=load_chapters)
+                _load_work(work, load_chapters=load_chapters)
             except AO3.utils.InvalidIdError as error:
                 warnings.warn(f'Could not load work #{work.id}')
         # pylint: disable=private-access
@@ -137,60 +268,90 @@ class AO3WorkOPDS:
             updated = work.date_edited
         else:
             updated = work.date_updated
-        self.updated = updated.astimezone(datetime.timezone.utc).isoformat()
+        self.updated = _isoformat_utc(updated)
         # Ensure `authors` is non-None. We iterate over it in `render()`
-        self.authors = []
-        for author in work.authors:
-            self.authors.append(AO3UserOPDS(author))
+        if author_cache is None:
+            self.authors = [AO3UserOPDS(author) for author in work.authors]
+        else:
+            self.authors = [
+                _cached_author(author, author_cache)
+                for author in work.authors]
         self.language = work.language
         self.publisher = AO3_PUBLISHER
-        self.published = work.date_published.astimezone(
-            datetime.timezone.utc).isoformat()
+        self.published = _isoformat_utc(work.date_published)
         self.summary = work.summary
 
-        self.categories = self.extract_categories()
-
+        # Add full-text and links to images if we have been asked.
+        # Do this here, rather than when rendering, so that any work
+        # needed to load the full text happens while building the feed
+        # (e.g. in threaded mode) and any errors are raised before a
+        # streamed feed has started to be sent:
         self.content = None
-        self.links = []
-
-        # Add an OPDSLink for each acquisition option (EPUB/etc.)
-        self.links.extend(self.get_acquisition_links(
-            filetypes=acquisition_filetypes))
-
-        # Add full-text and links to images if we have been asked:
-        # (Note: Either of these will cause the full text of the work
-        # to be fetched from the web if it hasn't already.)
+        self._image_links = []
         if get_content:
             self.content = self.get_content()
         if get_images:
-            self.links.extend(self.get_images())
+            self._image_links = self.get_images()
+
+        # The remaining attributes only need to scan the work's
+        # (already-loaded) HTML, so they are computed the first time
+        # they are accessed (e.g. when rendering):
+        self._acquisition_filetypes = _normalize_filetypes(
+            acquisition_filetypes)
+
+    @functools.cached_property
+    def categories(self) -> list[OPDSCategory]:
+        """ OPDS categories for each of the work's tags. """
+        return self.extract_categories()
+
+    @functools.cached_property
+    def links(self) -> list[OPDSLink]:
+        """ Acquisition links and (if requested) links to images. """
+        # Add an OPDSLink for each acquisition option (EPUB/etc.)
+        # (`_acquisition_filetypes` is already normalized.)
+        links = self._make_acquisition_links(
+            self._extract_download_urls(self._acquisition_filetypes))
+        links.extend(self._image_links)
+        return links
 
     def extract_categories(self) -> Iterable[OPDSCategory]:
         """ Converts an `AO3.Work`'s tags into `OPDSCategory` objects """
         # AO3 uses the concept of 'tags', which includes fandom,
         # character, relationship, ratings, categories, warnings,
         # and additional tags. We need to add each of these.
-        tags = (
-            self.work.categories + self.work.fandoms + self.work.characters +
-            self.work.relationships + self.work.warnings + self.work.tags)
+        tags = itertools.chain.from_iterable(
+            getattr(self.work, attr) for attr in AO3_TAG_ATTRIBUTES)
         if self.work.rating is not None:  # `rating` is an item, not a list
-            tags.append(self.work.rating)
+            tags = itertools.chain(tags, (self.work.rating,))
         # The `term` element of an OPDS category would ideally point to
         # the URL for each tag (e.g. for the "Explicit" tag, this would
         # be https://archiveofourown.org/tags/Explicit).
         # The element "label" is the human-readable term for that
         # specific tag. The "scheme" element is the same for all tags.
-        categories = [
+        # Works in a feed often share tags (e.g. fandoms), so intern them
+        # to keep one copy of each. (`AO3` gives us tags as BeautifulSoup
+        # strings, which need converting to `str` to be interned.)
+        return [
             OPDSCategory(self._tag_to_url(tag), AO3_TAG_SCHEMA, tag)
-            for tag in tags]
-        return categories
+            for tag in map(sys.intern, map(str, tags))]
+
+    @functools.cached_property
+    def _link_urls(self) -> dict[str, str]:
+        """ Maps the text of each link in the work's HTML to its url. """
+        # Collect these in one pass over the HTML, rather than searching
+        # the whole page once per tag. Where several links have the same
+        # text, keep the first (as `BeautifulSoup.find` would):
+        link_urls = {}
+        for link in self._soup.find_all('a', href=True):
+            if link.string is not None:
+                link_urls.setdefault(str(link.string), link.attrs['href'])
+        return link_urls
 
     def _tag_to_url(self, tag):
         """ Gets the url for an AO3 tag. """
         # Find the link that points to `tag` and return its url:
-        link = self._soup.find('a', string=tag)
-        if link is not None:
-            url = link.attrs['href']
+        url = self._link_urls.get(tag)
+        if url is not None:
             # Trim trailing `/works` portion of URL, if present:
             url = url.removesuffix('/works')
             return url
@@ -220,11 +381,9 @@ class AO3WorkOPDS:
         # Load the full text of the work if not already loaded:
         if not self.work.chapters:
             self.work.load_chapters()
-        # Load the full text of the work and store it:
-        content = ""
-        for chapter in self.work.chapters:
-            content += chapter
-        return content
+        # Join the text of each chapter in one pass. (`AO3.Work.chapters`
+        # holds `AO3.Chapter` objects, so use their `text`.)
+        return "".join(chapter.text for chapter in self.work.chapters)
 
     def get_images(self) -> Iterable[OPDSLink]:
         """ Converts an `AO3.Work`'s image links to `OPDSLink` objects. """
@@ -233,36 +392,37 @@ class AO3WorkOPDS:
             self.work.load_chapters()
         # The method AO3.Work.get_images() returns an awkward data
         # structure: a dict with chapter keys and tuple values, where
-        # the tuples' elements are pairs (paragraph_num, image_url). So:
-        # `{chapter_num: ((paragraph_num, image_url),...)}`
-        # We want to extract just the image URLs:
+        # the tuples' elements are pairs (image_url, paragraph_num). So:
+        # `{chapter_num: ((image_url, paragraph_num),...)}`
+        # We want to extract just the image URLs. The same image can
+        # appear several times in a work, but we only need one link to
+        # it, so drop duplicates (`dict` keys preserve order):
         image_dict = self.work.get_images()
-        images = []
-        for image_tuple in image_dict.values():
-            for (_, image_url) in image_tuple:
-                images.append(image_url)
-        # Now convert each image URL to an OPDSLink:
-        image_links = []
-        for image in images:
-            # Infer the MIME-type of the image (None if not inferable):
-            (image_mime, _) = mimetypes.guess_type(image)
-            image_links.append(
-                OPDSLink(image, rel=AO3_IMAGE_LINK_REL, type=image_mime))
-        return image_links
+        images = dict.fromkeys(
+            image_url for image_tuple in image_dict.values()
+            for (image_url, _) in image_tuple)
+        # Now convert each image URL to an OPDSLink, inferring its
+        # MIME-type (None if not inferable):
+        return [
+            OPDSLink(
+                image, rel=AO3_IMAGE_LINK_REL,
+                type=_guess_mime_type(image, AO3_IMAGE_MIME_TYPES))
+            for image in images]
 
     def get_acquisition_links(
             self, filetypes:Iterable[str]=None
         ) -> Iterable[OPDSLink]:
         """ Converts an `AO3.Work`'s acquisition links to `OPDSLink`s. """
+        return self._make_acquisition_links(
+            self._extract_download_urls(_normalize_filetypes(filetypes)))
+
+    def _make_acquisition_links(
+            self, link_urls: Iterable[str]) -> list[OPDSLink]:
+        """ Converts download urls to acquisition `OPDSLink`s. """
         links = []
-        link_urls = self._extract_download_urls(filetypes)
         for url in link_urls:
-            # `mimetypes` seems to have better luck if URLs are stripped
-            # of any non-path elements (i.e. query/fragment suffixes):
-            url_parts = urllib.parse.urlsplit(url)
-            guess_url = urllib.parse.urlunsplit((*url_parts[0:3], None, None))
             # Infer the MIME-type of the file (None if not inferable)
-            (mime, _) = mimetypes.guess_type(guess_url)
+            mime = _guess_mime_type(url, AO3_DOWNLOAD_MIME_TYPES)
             links.append(
                 OPDSLink(
                     url, rel=AO3_ACQUISITION_LINK_REL, type=mime,
@@ -275,41 +435,56 @@ class AO3WorkOPDS:
         # If we don't know the mime-type, return a generic title:
         if mime_type is None:
             return f'Download link for {self.work.title}'
-        # Otherwise, try to infer the extension for this type of file:
-        ext = mimetypes.guess_extension(mime_type)
-        # If we can't, use the generic title above:
-        if ext is None:
-            return self._get_acquisition_link_title(None)
+        # AO3's own filetypes have known names:
+        filetype = AO3_DOWNLOAD_MIME_FILETYPES.get(mime_type)
+        if filetype is None:
+            # Otherwise, try to infer the extension for this type of file:
+            ext = mimetypes.guess_extension(mime_type)
+            # If we can't, use the generic title above:
+            if ext is None:
+                return self._get_acquisition_link_title(None)
+            # First, convert mime-type extensions (e.g. '.pdf') to
+            # something friendlier (e.g. 'PDF)
+            filetype = ext.upper()
+            if filetype[0] == '.':
+                filetype = filetype[1:]
         # If we can infer the filetype, use a more informative title:
-        # First, convert mime-type extensions (e.g. '.pdf') to something
-        # friendlier (e.g. 'PDF)
-        filetype = ext.upper()
-        if filetype[0] == '.':
-            filetype = filetype[1:]
         return f'{filetype} download link for {self.work.title}'
 
     def _extract_download_urls(
-            self, filetypes: str | Iterable[str]=None) -> Iterable[str]:
-        """ Extracts download urls for an `AO3.Work` """
-        download_list = self._soup.find("li", {"class": "download"})
-        # For convenience, allow users to pass a single filetype as str:
-        if isinstance(filetypes, str):
-            filetypes = [filetypes]
-        # Convert filetypes to lowercase for easy comparison:
-        if filetypes is not None:
-            filetypes = list(map(str.lower, filetypes))
-        # Collect a list of download links:
-        urls = []
-        for download_option in download_list.findAll("li"):
-            # Get the link for each download option:
-            link = download_option.a
-            # Skip non-selected filetypes:
-            if filetypes is not None and link.getText().lower() not in filetypes:
-                continue
+            self, filetypes: frozenset[str]=None) -> Iterable[str]:
+        """ Extracts download urls for an `AO3.Work`
+
+        `filetypes` must already be normalized (see
+        `_normalize_filetypes`); if None, all urls are extracted.
+        """
+        # Collect a list of download links, skipping non-selected
+        # filetypes:
+        return [
+            url for (filetype, url) in self._get_download_links()
+            if filetypes is None or filetype in filetypes]
+
+    def _get_download_links(self) -> list[tuple[str, str]]:
+        """ Gets `(filetype, url)` pairs for an `AO3.Work`'s downloads.
+
+        `filetype` is lowercase (e.g. 'epub'). The pairs are cached on
+        the work's parsed HTML, so each work is only searched once even
+        if several `AO3WorkOPDS` objects are made from it. (Reloading
+        the work replaces its HTML, and so also discards the cache.)
+        """
+        links = self._soup.__dict__.get(_DOWNLOAD_LINKS_CACHE)
+        if links is not None:
+            return links
+        links = []
+        # Find the link for each download option in a single pass:
+        for link in DOWNLOAD_LINK_SELECTOR.select(self._soup):
             # The link is relative; resolve to an absolute reference:
             url = urllib.parse.urljoin(AO3_URL_BASE, link.attrs['href'])
-            urls.append(url)
-        return urls
+            links.append((link.getText().lower(), url))
+        # (Set this via `__dict__`; BeautifulSoup treats unknown
+        # attributes as searches for child tags.)
+        self._soup.__dict__[_DOWNLOAD_LINKS_CACHE] = links
+        return links
 
     def render(self):
         """ Renders this object as an OPDS feed entry.
@@ -319,14 +494,15 @@ class AO3WorkOPDS:
         It's not generally necessary to call this method unless you're
         trying to do something clever(/dangerous).
         """
-        # Pick the correct template (in this case, an OPDS feed entry):
-        template = env.get_template("entry.xml")
-        # Render the template for this entry and return the result:
-        return template.render(self.__dict__)
+        # Render the entry template for this entry and return the result:
+        return ENTRY_TEMPLATE.render(entry=self)
 
 class AO3UserOPDS:
     """ Renders an AO3.User as an atom:Person."""
 
+    # Feeds hold one of these per author per work, so skip `__dict__`:
+    __slots__ = ('name', 'uri', 'email')
+
     def __init__(self, user: AO3.User | str):
         if isinstance(user, str):
             self.name = user
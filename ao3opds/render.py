@@ -1,8 +1,11 @@
 """ Generate an OPDS feed from an AO3 user's Marked for Later list. """
 
 import warnings
+from typing import Iterator
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import AO3
-from ao3opds.opds import OPDSPerson, AO3OPDS
+from ao3opds.opds import OPDSPerson, AO3OPDS, AO3_URL_BASE, MAX_THREADS
 
 # Default values for Feed:
 FEED_NAMES = {
@@ -18,14 +21,39 @@ FEED_AUTHOR = OPDSPerson(
     uri='christopherscott.ca',
     email='christopher@christopherscott.ca')
 MAX_HISTORY_PAGES_DEFAULT = 3
+# Retry policy for requests to AO3 that fail because AO3 is briefly
+# unavailable. (Rate-limited requests, i.e. HTTP 429, are not retried
+# here; `ao3opds.opds` backs off and retries those when loading works.)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1  # seconds, doubled after each retry
+RETRY_STATUSES = (502, 503, 504)
 
-def _feed_opds(feed_id, works, session, id, title, authors, threaded):
-    """ Fetches a feed for `works` """
-    # The current version of `ao3_api` does not set the session on works
-    # returned from methods such as `session.get_marked_for_later()`,
-    # so do that here:
-    for work in works:
-        work.set_session(session)
+def _configure_session(session: AO3.Session):
+    """ Configures the connection pool that `session` uses for AO3.
+
+    The pool is sized so that each thread used to fetch works in
+    threaded mode can keep its own connection alive, and requests that
+    fail while AO3 is briefly unavailable are retried with back-off.
+    Each session is only configured once, so that repeated feeds reuse
+    the same pool.
+    """
+    if AO3_URL_BASE in session.session.adapters:
+        return
+    retries = Retry(
+        total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        # Return the final response so `AO3` raises its own errors:
+        raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=MAX_THREADS, max_retries=retries)
+    session.session.mount(AO3_URL_BASE, adapter)
+
+def _feed_opds(
+        feed_id, works, session, id, title, authors, threaded, stream):
+    """ Fetches a feed for `works`
+
+    If `stream` is True, the feed is returned as an iterator of chunks
+    of the feed (see `AO3OPDS.generate`) rather than a single str.
+    """
     # Default arguments:
     if id is None:
         id=FEED_ID.format(feed_id=feed_id)
@@ -36,51 +64,65 @@ def _feed_opds(feed_id, works, session, id, title, authors, threaded):
         authors=[FEED_AUTHOR]
 
     # Generate an OPDS feed for the works:
+    # (`AO3OPDS` attaches `session` to any works that it needs to load)
     opds = AO3OPDS(
-        works, id=id, title=title, authors=authors, threaded=threaded)
+        works, id=id, title=title, authors=authors, threaded=threaded,
+        session=session)
+    if stream:
+        return opds.generate()
     feed = opds.render()
     return feed
 
 def marked_for_later_opds(
         session: AO3.Session, id:str=None, title:str=None,
-        authors:list[OPDSPerson]=None, threaded=False) -> str:
+        authors:list[OPDSPerson]=None, threaded=False,
+        stream=False) -> str | Iterator[str]:
     """ Returns an OPDS feed of Marked for Later works for a user. """
     if session is None:
         return None
+    _configure_session(session)
     # Get the user's Marked for Later list:
     works: list[AO3.Work] = session.get_marked_for_later()
     feed_id = 'marked_for_later'
-    return _feed_opds(feed_id, works, session, id, title, authors, threaded)
+    return _feed_opds(
+        feed_id, works, session, id, title, authors, threaded, stream)
 
 def bookmarks_opds(
         session: AO3.Session, id:str=None, title:str=None,
-        authors:list[OPDSPerson]=None, threaded=False) -> str:
+        authors:list[OPDSPerson]=None, threaded=False,
+        stream=False) -> str | Iterator[str]:
     """ Returns an OPDS feed of bookmarks works for a user. """
     if session is None:
         return None
+    _configure_session(session)
     # Get the user's bookmarks and convert them to Works:
     bookmarks:list[tuple] = session.get_bookmarks(use_threading=threaded)
     works: list[AO3.Work] = [AO3.Work(
         work_id, session, load=False) for (work_id, _, _) in bookmarks]
     feed_id = 'bookmarks'
-    return _feed_opds(feed_id, works, session, id, title, authors, threaded)
+    return _feed_opds(
+        feed_id, works, session, id, title, authors, threaded, stream)
 
 def subscriptions_opds(
         session: AO3.Session, id:str=None, title:str=None,
-        authors:list[OPDSPerson]=None, threaded=False) -> str:
+        authors:list[OPDSPerson]=None, threaded=False,
+        stream=False) -> str | Iterator[str]:
     """ Returns an OPDS feed of works in a user's subscriptions list. """
     if session is None:
         return None
+    _configure_session(session)
     # Get the user's subscriptions (limited to Works):
     works:list[AO3.Work] = session.get_work_subscriptions(
         use_threading=threaded)
     feed_id = 'subscriptions'
-    return _feed_opds(feed_id, works, session, id, title, authors, threaded)
+    return _feed_opds(
+        feed_id, works, session, id, title, authors, threaded, stream)
 
 def history_opds(
         session: AO3.Session, id:str=None, title:str=None,
         authors:list[OPDSPerson]=None, threaded=False,
-        max_pages=MAX_HISTORY_PAGES_DEFAULT) -> str:
+        max_pages=MAX_HISTORY_PAGES_DEFAULT,
+        stream=False) -> str | Iterator[str]:
     """ Returns an OPDS feed of works in a user's subscriptions list.
 
     This method performs a first pass of a user's history in a
@@ -89,8 +131,10 @@ def history_opds(
     """
     if session is None:
         return None
+    _configure_session(session)
     # Get the user's history (limiting pages to avoid rate-limits):
     history:list[tuple] = session.get_history(max_pages=max_pages)
     works:list[AO3.Work] = [work for (work, _, _) in history]
     feed_id = 'history'
-    return _feed_opds(feed_id, works, session, id, title, authors, threaded)
+    return _feed_opds(
+        feed_id, works, session, id, title, authors, threaded, stream)
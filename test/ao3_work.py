@@ -1,5 +1,6 @@
 """ Provides an `AO3.Work` for testing. """
 
+import os
 import sys
 import warnings
 import AO3
@@ -14,21 +15,32 @@ try:
     with open(PICKLE_FILE, 'rb') as file:
         TEST_WORK = pickle.load(file)
     if TEST_WORK.id != TEST_WORK_ID:
-        raise BaseException('Wrong work loaded, go to except block')
-except:
-    # Loads all metadata and full-text content via network requests:
+        raise ValueError('Wrong work loaded, go to except block')
+except Exception:
+    # The pickle may be missing, or unusable (e.g. written by another
+    # version of `AO3` or BeautifulSoup), so load all metadata and
+    # full-text content via network requests instead:
     TEST_WORK = AO3.Work(TEST_WORK_ID)
     # Attempt to write this to file to accelerate future tests:
+    # Increase recursion limit to account for high level of
+    # recursion in BeautifulSoup objects. (`AO3.Work` pickles its page
+    # as HTML, but each `AO3.Chapter` pickles its BeautifulSoup tree.)
+    # See:
+    # https://docs.python.org/3/library/pickle.html#what-can-be-pickled-and-unpickled
+    # https://stackoverflow.com/a/52975220
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(10000)
     try:
-        # Increase recursion limit to account for high level of
-        # recursion in BeautifulSoup objects. See:
-        # https://docs.python.org/3/library/pickle.html#what-can-be-pickled-and-unpickled
-        # https://stackoverflow.com/a/52975220
-        limit = sys.getrecursionlimit()
-        sys.setrecursionlimit(10000)
-        with open(PICKLE_FILE, 'wb') as file:
+        # Write to a temporary file first, so that a failed write
+        # doesn't leave a truncated pickle behind:
+        with open(PICKLE_FILE + '.tmp', 'wb') as file:
             pickle.dump(TEST_WORK, file, pickle.HIGHEST_PROTOCOL)
-    except:
+        os.replace(PICKLE_FILE + '.tmp', PICKLE_FILE)
+    except (OSError, pickle.PicklingError, RecursionError):
+        try:
+            os.remove(PICKLE_FILE + '.tmp')
+        except OSError:
+            pass
         warnings.warn(
             "Could not write test work to disk. " +
             "Repeated tests may result in rate-limiting.")
@@ -2,32 +2,54 @@
 
 from copy import copy
 import unittest
+import unittest.mock
 import datetime
+import itertools
+import sys
 import xml.etree.ElementTree as xml
+import AO3
 import ao3opds.opds
 from ao3_work import TEST_WORK
 
+# Fully-qualified tags used to look up elements of a rendered feed:
+ATOM_NAMESPACE = 'http://www.w3.org/2005/Atom'
+ATOM_ID = f'{{{ATOM_NAMESPACE}}}id'
+ATOM_TITLE = f'{{{ATOM_NAMESPACE}}}title'
+ATOM_ENTRY = f'{{{ATOM_NAMESPACE}}}entry'
+
 class TestAO3ABC(unittest.TestCase):
     """ ABC for test cases of `ao3opds.opds` classes. """
 
-    def setUp(self) -> None:
-        # Get a work without fetching any data over the network:
-        self.work = copy(TEST_WORK)  # copy to avoid mutating
-        return super().setUp()
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Get a work without fetching any data over the network. Tests
+        # only read it, so every test can share the one fixture:
+        cls.work = TEST_WORK
+        return super().setUpClass()
 
 class TestAO3OPDS(TestAO3ABC):
     """ Tests `ao3opds.opds.AO3OPDS` """
 
-    def setUp(self) -> None:
-        super().setUp()
-        self.works = [self.work]
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        # Tests only read the works and the feed, so share one tuple of
+        # works and build, render and parse one feed for them all
+        # (threaded tests build their own):
+        cls.works = (cls.work,)
+        cls.opds = ao3opds.opds.AO3OPDS(cls.works, id='id', title='title')
+        cls.feed = cls.opds.render()
+        try:
+            cls.root = xml.fromstring(cls.feed)
+        except xml.ParseError as error:
+            cls.root = None
+            cls.parse_error = error
 
     def test_entries(self):
         """ Tests that AO3WorksOPDS attrs are processed. """
-        opds = ao3opds.opds.AO3OPDS(self.works, id='id', title='title')
         # Confirm that self.works has the correct structure
-        self.assertEqual(len(opds.entries), len(self.works))
-        for index, entry in enumerate(opds.entries):
+        self.assertEqual(len(self.opds.entries), len(self.works))
+        for index, entry in enumerate(self.opds.entries):
             # Check a couple of entry attributes to confirm that
             # each entry matches the corresponding Work:
             self.assertEqual(entry.title, self.works[index].title)
@@ -38,36 +60,37 @@ class TestAO3OPDS(TestAO3ABC):
 
     def test_render_id(self):
         """ Tests that AO3OPDS feeds generate ids correctly. """
-        opds = ao3opds.opds.AO3OPDS(self.works, id='id!', title='title!')
-        feed = opds.render()
         # Check for an OPDS 'id' tag with the correct value:
-        self.assertIn(f'<id>{opds.id}</id>', feed)
+        self.assertEqual(self.root.findtext(ATOM_ID), self.opds.id)
 
     def test_render_title(self):
         """ Tests that AO3OPDS feeds generate titles correctly. """
-        opds = ao3opds.opds.AO3OPDS(self.works, id='id!', title='title!')
-        feed = opds.render()
-        # Check for an OPDS 'id' tag with the correct value:
-        self.assertIn(f'<title>{opds.title}</title>', feed)
+        # Check for an OPDS 'title' tag with the correct value:
+        self.assertEqual(self.root.findtext(ATOM_TITLE), self.opds.title)
 
     def test_render_entries(self):
         """ Tests that AO3OPDS feeds generate entries correctly. """
-        opds = ao3opds.opds.AO3OPDS(self.works, id='id', title='title')
-        feed = opds.render()
         # Confirm that each work in `opds.works` has its id and title
-        # in the feed:
-        for entry in opds.entries:
-            self.assertIn(f'<id>{entry.id}</id>', feed)
-            self.assertIn(f'<title>{entry.title}</title>', feed)
+        # in the feed, in order:
+        elements = self.root.findall(ATOM_ENTRY)
+        self.assertEqual(len(elements), len(self.opds.entries))
+        for entry, element in zip(self.opds.entries, elements):
+            self.assertEqual(element.findtext(ATOM_ID), entry.id)
+            self.assertEqual(element.findtext(ATOM_TITLE), entry.title)
 
     def test_render_XML(self):
         """ Tests that AO3OPDS.render() generates valid XML. """
-        opds = ao3opds.opds.AO3OPDS(self.works, id='id', title='title')
-        feed = opds.render()
-        try:
-            _ = xml.fromstring(feed)
-        except xml.ParseError as error:
-            self.fail('OPDS feed is not valid XML. Parser error: ' + str(error))
+        # The feed is parsed once, in `setUpClass`:
+        if self.root is None:
+            self.fail(
+                'OPDS feed is not valid XML. Parser error: ' +
+                str(self.parse_error))
+
+    def test_generate(self):
+        """ Tests that AO3OPDS.generate() streams the rendered feed. """
+        # Streaming the feed should produce the same output as rendering
+        # it all at once:
+        self.assertEqual("".join(self.opds.generate()), self.feed)
 
     def test_threaded_1(self):
         """ Tests that AO3OPDS works with threaded=True and one AO3.Work """
@@ -87,114 +110,228 @@ class TestAO3OPDS(TestAO3ABC):
         """ Tests that AO3OPDS works with threaded=True and two AO3.Works """
         # This is the same as `test_threaded_1`, except that there are
         # two works (and thus two threads).
-        self.works.append(copy(self.work))
+        works = (*self.works, copy(self.work))
         opds = ao3opds.opds.AO3OPDS(
-            self.works, id='id', title='title', threaded=True)
-        # Confirm that self.works has the correct structure
-        self.assertEqual(len(opds.entries), len(self.works))
+            works, id='id', title='title', threaded=True)
+        # Confirm that works has the correct structure
+        self.assertEqual(len(opds.entries), len(works))
         for index, entry in enumerate(opds.entries):
             # Check a couple of entry attributes to confirm that
             # each entry matches the corresponding Work:
-            self.assertEqual(entry.title, self.works[index].title)
-            self.assertEqual(entry.summary, self.works[index].summary)
+            self.assertEqual(entry.title, works[index].title)
+            self.assertEqual(entry.summary, works[index].summary)
+
+    def test_filetype(self):
+        """ Tests passing `acquisition_filetypes` to AO3OPDS. """
+        opds = ao3opds.opds.AO3OPDS(
+            self.works, id='id', title='title', acquisition_filetypes="EPUB")
+        # Verify that each entry has links and all links are to epubs:
+        for entry in opds.entries:
+            self.assertGreater(len(entry.links), 0)
+            for link in entry.links:
+                self.assertTrue('epub' in link.type.lower())
 
 class TestAO3WorkOPDS(TestAO3ABC):
     """ Tests `ao3opds.opds.AO3WorkOPDS`. """
 
-    def test_init_title(self):
-        """ Tests that the AO3WorkOPDS.title attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
-        self.assertEqual(opds.title, self.work.title)
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        # Building an AO3WorkOPDS is deterministic for a given work, so
+        # build each variant once and let the tests inspect it:
+        cls.opds = ao3opds.opds.AO3WorkOPDS(cls.work)
+        cls.epub_opds = ao3opds.opds.AO3WorkOPDS(
+            cls.work, acquisition_filetypes=["EPUB"])
+        cls.content_opds = ao3opds.opds.AO3WorkOPDS(
+            cls.work, get_content=True)
 
-    def test_init_authors(self):
-        """ Tests that the AO3WorkOPDS.authors attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
-        for index, author_name in enumerate(self.work.authors):
-            self.assertEqual(opds.authors[index].name, author_name)
+    def test_init_attrs(self):
+        """ Tests that attrs copied directly from the work are set. """
+        # These attrs should match the work's attrs of the same name:
+        for attr in ('title', 'language', 'summary'):
+            with self.subTest(attr=attr):
+                self.assertEqual(
+                    getattr(self.opds, attr), getattr(self.work, attr))
 
     def test_init_categories(self):
         """ Tests that the AO3WorkOPDS.categories attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
         # OPDS categories should include all AO3 tags, namely categories,
         # characters, fandoms, relationships, warnings, the rating, and
         # other tags. See https://archiveofourown.org/faq/tags
-        tags = (
-            self.work.categories + self.work.characters + self.work.fandoms +
-            [self.work.rating] + self.work.relationships + self.work.tags +
-            self.work.warnings)
+        tags = set(itertools.chain(
+            self.work.categories, self.work.characters, self.work.fandoms,
+            [self.work.rating], self.work.relationships, self.work.tags,
+            self.work.warnings))
         # AO3 categories are represented in the `term` and `label`
         # elements of an OPDS category; use `label`, which is 
         # human-readable:
-        categories = [category.label for category in opds.categories]
-        for tag in tags:
-            self.assertIn(tag, categories)
+        categories = {category.label for category in self.opds.categories}
+        missing = tags - categories
+        self.assertFalse(missing, f'Missing category labels: {missing}')
 
     def test_init_id(self):
         """ Tests that the AO3WorkOPDS.id attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
         # AO3.Work.id is a five-digit integer. That isn't sufficient for
         # an OPDS id (which must be unique across namespaces).
         # Require that AO3OPDS generates a new canonical id that's
         # stable across test runs, namely the canonical url of the work.
-        self.assertEqual(opds.id, self.work.url.lower())
+        self.assertEqual(self.opds.id, self.work.url.lower())
 
     def test_init_updated(self):
         """ Tests that the AO3WorkOPDS.updated attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
         # OPDS dates must be ISO-formatted (this test has no requirement
         # on the specific datetime value)
         try:
-            datetime.datetime.fromisoformat(opds.updated)
+            datetime.datetime.fromisoformat(self.opds.updated)
         except:
             self.fail('opds.updated is not in ISO-format.')
 
     def test_init_published(self):
         """ Tests that the AO3WorkOPDS.published attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
         # OPDS dates must be ISO-formatted (this test has no requirement
         # on the specific datetime value)
         try:
-            datetime.datetime.fromisoformat(opds.published)
+            datetime.datetime.fromisoformat(self.opds.published)
         except:
             self.fail('opds.published is not in ISO-format.')
 
     def test_init_authors(self):
         """ Tests that the AO3WorkOPDS.authors attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
         # AO3.Work represents authors as AO3.User objects, which have
         # names and urls. OPDSPerson provides fields for name, email,
         # and uri.
-        for index, author in enumerate(self.work.authors):
-            self.assertEqual(opds.authors[index].name, author.username)
-            self.assertEqual(opds.authors[index].uri, author.url)
-
-    def test_init_language(self):
-        """ Tests that the AO3WorkOPDS.language attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
-        self.assertEqual(opds.language, self.work.language)
-
-    def test_init_summary(self):
-        """ Tests that the AO3WorkOPDS.summary attr is set properly. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
-        self.assertEqual(opds.summary, self.work.summary)
+        for opds_author, author in zip(
+                self.opds.authors, self.work.authors, strict=True):
+            self.assertEqual(opds_author.name, author.username)
+            self.assertEqual(opds_author.uri, author.url)
 
     def test_init_links(self):
         """ Tests that the AO3WorkOPDS.links attr is non-empty. """
-        opds = ao3opds.opds.AO3WorkOPDS(self.work)
         # AO3WorkOPDS should populate with one or more acquisition links
-        self.assertGreater(len(opds.links), 0)
+        self.assertGreater(len(self.opds.links), 0)
 
     def test_init_filetype(self):
         """ Tests passing `acquisition_filetypes` to AO3WorkOPDS. """
-        opds = ao3opds.opds.AO3WorkOPDS(
-            self.work, acquisition_filetypes=["EPUB"])
         # Verify that there is at least one link and all links are to epubs:
-        self.assertGreater(len(opds.links), 0)
-        for link in opds.links:
+        self.assertGreater(len(self.epub_opds.links), 0)
+        for link in self.epub_opds.links:
             self.assertTrue('epub' in link.type.lower())
 
-    # TODO: Test get_images and get_content
+    def test_init_filetype_case(self):
+        """ Tests that `acquisition_filetypes` is case-insensitive. """
+        opds = ao3opds.opds.AO3WorkOPDS(
+            self.work, acquisition_filetypes=frozenset({"ePub"}))
+        for links in (opds.links, opds.get_acquisition_links(frozenset({"ePub"}))):
+            # Verify that there is at least one link and all links are
+            # to epubs:
+            self.assertGreater(len(links), 0)
+            for link in links:
+                self.assertTrue('epub' in link.type.lower())
+
+    def test_init_content(self):
+        """ Tests passing `get_content` to AO3WorkOPDS. """
+        # Content is omitted unless requested:
+        self.assertIsNone(self.opds.content)
+        # The content is the text of every chapter, in order:
+        self.assertEqual(
+            self.content_opds.content,
+            "".join(chapter.text for chapter in self.work.chapters))
+
+    def test_init_images(self):
+        """ Tests passing `get_images` to AO3WorkOPDS. """
+        # Images are omitted unless requested:
+        self.assertFalse(any(
+            link.rel == ao3opds.opds.AO3_IMAGE_LINK_REL
+            for link in self.opds.links))
+        # Give a copy of the work some known images, in the same form
+        # as `AO3.Work.get_images()`, i.e. `{chapter: ((url, line),...)}`.
+        # The same PNG appears twice, in different chapters:
+        work = copy(self.work)
+        work.get_images = lambda: {
+            1: (('https://example.com/groot.png', 1),
+                ('https://example.com/rocket.jpg?size=large', 4)),
+            2: (('https://example.com/groot.png', 2),)}
+        opds = ao3opds.opds.AO3WorkOPDS(work, get_images=True)
+        image_links = [
+            link for link in opds.links
+            if link.rel == ao3opds.opds.AO3_IMAGE_LINK_REL]
+        # Each image should be linked (by its URL) exactly once, in order:
+        self.assertEqual(
+            [link.href for link in image_links],
+            ['https://example.com/groot.png',
+             'https://example.com/rocket.jpg?size=large'])
+        self.assertEqual(
+            [link.type for link in image_links], ['image/png', 'image/jpeg'])
+
+class StubWork:
+    """ Stands in for an `AO3.Work` whose `reload` fails at first. """
+
+    def __init__(self, error: Exception, failures: int):
+        self.error = error
+        self.failures = failures  # Number of times `reload` will fail
+        self.attempts = 0
+
+    def reload(self, load_chapters=False):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise self.error
+
+class TestLoadWork(unittest.TestCase):
+    """ Tests `ao3opds.opds._load_work` """
+
+    def setUp(self) -> None:
+        # Record back-off delays rather than actually sleeping:
+        patcher = unittest.mock.patch('ao3opds.opds.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def delays(self):
+        """ Returns the delays that `_load_work` slept for. """
+        return [call.args[0] for call in self.sleep.call_args_list]
+
+    def test_no_retry(self):
+        """ Tests that a work that loads is only loaded once. """
+        work = StubWork(AO3.utils.HTTPError('429'), failures=0)
+        ao3opds.opds._load_work(work)
+        self.assertEqual(work.attempts, 1)
+        self.assertEqual(self.delays(), [])
+
+    def test_retry(self):
+        """ Tests that rate-limited loads back off and retry. """
+        failures = ao3opds.opds.MAX_LOAD_ATTEMPTS - 1
+        work = StubWork(AO3.utils.HTTPError('429'), failures=failures)
+        ao3opds.opds._load_work(work)
+        self.assertEqual(work.attempts, failures + 1)
+        # Delays start at LOAD_BACKOFF and double after each attempt:
+        self.assertEqual(
+            self.delays(),
+            [ao3opds.opds.LOAD_BACKOFF * 2**n for n in range(failures)])
+
+    def test_retry_limit(self):
+        """ Tests that loads are abandoned after MAX_LOAD_ATTEMPTS. """
+        max_attempts = ao3opds.opds.MAX_LOAD_ATTEMPTS
+        work = StubWork(AO3.utils.HTTPError('429'), failures=max_attempts)
+        with self.assertRaises(AO3.utils.HTTPError):
+            ao3opds.opds._load_work(work)
+        self.assertEqual(work.attempts, max_attempts)
+        # There's no need to wait after the final attempt:
+        self.assertEqual(len(self.delays()), max_attempts - 1)
+
+    def test_invalid_id(self):
+        """ Tests that other errors are not retried. """
+        work = StubWork(AO3.utils.InvalidIdError('invalid'), failures=1)
+        with self.assertRaises(AO3.utils.InvalidIdError):
+            ao3opds.opds._load_work(work)
+        self.assertEqual(work.attempts, 1)
+        self.assertEqual(self.delays(), [])
 
 if __name__ == '__main__':
-    unittest.TextTestRunner().run(
-        unittest.TestLoader().loadTestsFromName(__name__))
+    # Load the test cases directly rather than scanning the module:
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite(
+        loader.loadTestsFromTestCase(case)
+        for case in (TestAO3OPDS, TestAO3WorkOPDS, TestLoadWork))
+    # Buffer output from passing tests rather than writing it out:
+    result = unittest.TextTestRunner(buffer=True).run(suite)
+    # Report failure via the exit status (as `unittest.main` would):
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,58 @@
+""" Tests ao3opds.render """
+
+from collections.abc import Iterator
+import unittest
+import requests
+import ao3opds.render
+from ao3_work import TEST_WORK
+
+class FakeSession:
+    """ Stands in for an `AO3.Session` whose lists hold `TEST_WORK`.
+
+    This lets feeds be built without logging in to AO3.
+    """
+
+    username = 'username'
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def get_marked_for_later(self):
+        return [TEST_WORK]
+
+    def get_bookmarks(self, use_threading=False):
+        # Bookmarks are returned as work ids, which would need to be
+        # loaded over the network, so leave these empty:
+        return []
+
+    def get_work_subscriptions(self, use_threading=False):
+        return [TEST_WORK]
+
+    def get_history(self, max_pages=None):
+        return [(TEST_WORK, None, None)]
+
+class TestRender(unittest.TestCase):
+    """ Tests the feed functions of `ao3opds.render` """
+
+    FEED_FUNCTIONS = (
+        ao3opds.render.marked_for_later_opds,
+        ao3opds.render.bookmarks_opds,
+        ao3opds.render.subscriptions_opds,
+        ao3opds.render.history_opds)
+
+    def test_render(self):
+        """ Tests that feed functions return a str by default. """
+        for feed_function in self.FEED_FUNCTIONS:
+            with self.subTest(feed=feed_function.__name__):
+                self.assertIsInstance(feed_function(FakeSession()), str)
+
+    def test_stream(self):
+        """ Tests that feed functions stream with `stream=True`. """
+        for feed_function in self.FEED_FUNCTIONS:
+            with self.subTest(feed=feed_function.__name__):
+                feed = feed_function(FakeSession(), stream=True)
+                self.assertIsInstance(feed, Iterator)
+                self.assertIn('</feed>', "".join(feed))
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)